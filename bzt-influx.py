@@ -3,60 +3,104 @@
 # This extension does not include Influx. You must manage the installation separately.
 # Data format closely matches (no guarantees) the data format from Jmeter
 
-import copy
-import logging
-import os
-import platform
+import gzip
+import socket
 import sys
 import time
 import traceback
-import json
-from abc import abstractmethod
-from collections import defaultdict, OrderedDict, Counter, namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from ssl import SSLError
 import requests
-import yaml
-from requests.exceptions import ReadTimeout, ConnectionError, ConnectTimeout
-from urwid import Pile, Text
-from bzt import TaurusInternalException, TaurusConfigError, TaurusException, TaurusNetworkError, NormalShutdown
-from bzt.engine import Reporter, Provisioning, ScenarioExecutor, Configuration, Service
-from bzt.engine import Singletone, SETTINGS
-from bzt.modules.aggregator import DataPoint, KPISet, ConsolidatingAggregator, ResultsProvider, AggregatorListener
-from bzt.modules.monitoring import Monitoring, MonitoringListener, LocalClient
-from bzt.modules.services import Unpacker
-from bzt.modules.selenium import SeleniumExecutor
-from bzt.requests_model import has_variable_pattern
-from bzt.six import BytesIO, iteritems, HTTPError, r_input, URLError, b, string_types, text_type
-from bzt.utils import BetterDict
-from bzt.utils import to_json, dehumanize_time
+from requests.adapters import HTTPAdapter
+from requests.exceptions import ReadTimeout
+from urllib3.util.retry import Retry
+from bzt import TaurusConfigError, TaurusNetworkError
+from bzt.engine import Reporter, Singletone
+from bzt.modules.aggregator import DataPoint, KPISet, ResultsProvider, AggregatorListener
+from bzt.modules.monitoring import MonitoringListener
+from bzt.six import URLError
+from bzt.utils import dehumanize_time
+
+# line protocol requires commas, spaces and equal signs in tag values to be escaped,
+# backslashes are doubled so they can't escape a following separator,
+# newlines can't be escaped at all so they become spaces
+_TAG_ESCAPE = str.maketrans({',': r'\,', ' ': r'\ ', '=': r'\=', '\\': '\\\\', '\n': r'\ ', '\r': r'\ '})
+
+# tag values can't be empty in line protocol
+_EMPTY_TAG = "none"
+
+
+def _tag_value(value):
+    """
+    Formats a tag value of unknown type (error messages may come as bytes) and escapes it
+    """
+    if isinstance(value, bytes):
+        value = value.decode("utf-8", "replace")
+    elif not isinstance(value, str):
+        value = str(value)
+    return value.translate(_TAG_ESCAPE) if value else _EMPTY_TAG
+
 
 class InfluxUploader(Reporter, AggregatorListener, MonitoringListener, Singletone):
     """
     Reporter class
     """
 
+    # timestamp multipliers from seconds. send-precision must match the precision param of influx-url,
+    # udp-precision must match the precision of the Influx UDP listener, which defaults to ns
+    TIMESTAMP_MULTIPLIERS = {"s": 1, "ms": 1000, "u": 1000000, "ns": 1000000000}
+
+    # max size of a single UDP datagram, rows are never split across datagrams
+    UDP_PAYLOAD_SIZE = 8192
+
     def __init__(self):
         super(InfluxUploader, self).__init__()
         self.kpi_buffer = []
+        self._events_buf = []
         self.send_interval = 10
         self._last_status_check = time.time()
         self.send_data = True
         self.upload_artifacts = True
         self.send_monitoring = True
         self.monitoring_buffer = None
-        self.last_dispatch = 0
+        self._next_flush = 0
         self.influx_url = "None"
+        self.influx_udp = None
+        self.udp_precision = "ns"
+        self.udp_ts_multi = 1000000000
+        self.udp_kpi = False
+        self._udp_sock = None
+        self._udp_addr = None
         self.influx_application = "None"
         self.influx_measurement = "None"
+        self.influx_precision = "ms"
+        self.ts_multi = 1000
+        self._line_prefix = ""
         self.first_ts = sys.maxsize
         self.last_ts = 0
         self.report_name = None
         self._dpoint_serializer = InfluxDatapointSerializer(self)
-        self.resend_timeout = 2.0
+        self.resend_timeout = 0.5
+        self._session = None
+        self.gzip = True
+        self.int_fields = True
+        self.batch_size = 5000
+        self.max_buffer = 50000
+        self.max_pending = 8
+        self._executor = None
+        self._pending = []
+        self._payload_buf = bytearray()
 
     def prepare(self):
         super(InfluxUploader, self).prepare()
         self.send_interval = dehumanize_time(self.settings.get("send-interval", self.send_interval))
+        self.gzip = self.settings.get("gzip", self.gzip)
+        # field types are fixed per measurement in Influx, keep this consistent across runs
+        self.int_fields = self.settings.get("int-fields", self.int_fields)
+        self._dpoint_serializer.int_suffix = "i" if self.int_fields else ""
+        self.batch_size = int(self.settings.get("batch-size", self.batch_size))
+        self.max_buffer = int(self.settings.get("max-buffer", self.max_buffer))
+        self.max_pending = int(self.settings.get("max-pending", self.max_pending))
         if isinstance(self.engine.aggregator, ResultsProvider):
             self.engine.aggregator.add_listener(self)
         self.influx_application=self.parameters.get("application")
@@ -64,6 +108,49 @@ class InfluxUploader(Reporter, AggregatorListener, MonitoringListener, Singleton
         self.influx_url=self.parameters.get("influx-url")
         if self.parameters.get("resend-timeout"):
             self.resend_timeout=float(self.parameters.get("resend-timeout"))
+        self.influx_precision=self.parameters.get("send-precision", self.influx_precision)
+        if self.influx_precision not in self.TIMESTAMP_MULTIPLIERS:
+            raise TaurusConfigError("Unsupported send-precision for Influx: %s" % self.influx_precision)
+        self.ts_multi = self.TIMESTAMP_MULTIPLIERS[self.influx_precision]
+        self.influx_udp=self.parameters.get("influx-udp", self.influx_udp)
+        self.udp_kpi = self.settings.get("udp-kpi", self.udp_kpi)
+        self.udp_precision=self.parameters.get("udp-precision", self.udp_precision)
+        if self.udp_precision not in self.TIMESTAMP_MULTIPLIERS:
+            raise TaurusConfigError("Unsupported udp-precision for Influx: %s" % self.udp_precision)
+        self.udp_ts_multi = self.TIMESTAMP_MULTIPLIERS[self.udp_precision]
+        if self.influx_udp:
+            host, _, port = self.influx_udp.rpartition(":")
+            host = host.strip("[]")
+            if not host or not port.isdigit():
+                raise TaurusConfigError("influx-udp must be in host:port form, got: %s" % self.influx_udp)
+            # resolve once, sendto() with a hostname would do a lookup per datagram
+            try:
+                family, sock_type, proto, _, self._udp_addr = socket.getaddrinfo(host, int(port), type=socket.SOCK_DGRAM)[0]
+            except socket.gaierror as exc:
+                raise TaurusConfigError("Can't resolve influx-udp address %s: %s" % (self.influx_udp, exc))
+            self._udp_sock = socket.socket(family, sock_type, proto)
+            if self.udp_kpi:
+                # KPI rows go to the UDP listener, so they follow its precision
+                self.ts_multi = self.udp_ts_multi
+        elif self.udp_kpi:
+            raise TaurusConfigError("udp-kpi requires the influx-udp parameter")
+
+        # single keep-alive session for all writes, avoids a new connection per flush
+        self._session = requests.Session()
+        # resend-timeout is the base delay of the exponential backoff between retries
+        retry = Retry(total=3, backoff_factor=self.resend_timeout, status_forcelist=(500, 502, 503, 504),
+                      allowed_methods=frozenset(["POST"]), raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=4, max_retries=retry)
+        self._session.mount("http://", adapter)
+        self._session.mount("https://", adapter)
+
+        # writes happen off the main thread so a slow Influx doesn't stall aggregation
+        self._executor = ThreadPoolExecutor(max_workers=1)
+
+        self._next_flush = time.monotonic() + self.send_interval
+
+        # measurement and application tags are identical for every row
+        self._line_prefix = f"{self.influx_measurement},application={self.influx_application},"
 
 
     def startup(self):
@@ -71,53 +158,137 @@ class InfluxUploader(Reporter, AggregatorListener, MonitoringListener, Singleton
         Logs test start time in influx
         """
         super(InfluxUploader, self).startup()
-        self.__send_kpi_data("events,application="+self.influx_application + ",title=ApacheJMeter text=\"TestTitle started\" " +  str(int(round(time.time() * 1000))))
+        self.__add_event("TestTitle started")
       
     def shutdown(self):
         """
         Logs test end time in influx
         """
-        self.__send_kpi_data("events,application="+self.influx_application + ",title=ApacheJMeter text=\"TestTitle ended\" " +  str(int(round(time.time() * 1000))))
+        self.__wait_pending()
+        self.__add_event("TestTitle ended")
+
+    def __add_event(self, text):
+        """
+        Sends an event marker over UDP if configured,
+        otherwise queues it to be sent along with the next KPI flush
+        """
+        udp = self._udp_sock is not None
+        timestamp = int(round(time.time() * (self.udp_ts_multi if udp else self.ts_multi)))
+        event = f"events,application={self.influx_application},title=ApacheJMeter text=\"{text}\" {timestamp}\n"
+        if udp:
+            self.__send_udp(event.encode("utf-8"))
+        else:
+            self._events_buf.append(event.encode("utf-8"))
 
     def post_process(self):
         """
         Upload results if possible
         """
         self.log.info("KPI bulk buffer len in post-proc: %s", len(self.kpi_buffer))
+        self.__wait_pending()
         try:
             self.log.info("Influx: Sending remaining KPI data to server...")
             if self.send_data:
-                self.__send_data(self.kpi_buffer)
+                rows = self._events_buf + self.kpi_buffer
+                self._events_buf = []
                 self.kpi_buffer = []
+                for start in range(0, len(rows), self.batch_size):
+                    self.__send_data(rows[start:start + self.batch_size])
         except Exception as e:
             self.log.info("Error in post process")
             self.log.debug(str(e))
+        finally:
+            if self._session is not None:
+                self._session.close()
+            if self._udp_sock is not None:
+                self._udp_sock.close()
 
     def check(self):
         """
         Send data if any in buffer
         """
         self.log.debug("Influx: KPI bulk buffer len: %s", len(self.kpi_buffer))
-        if self.last_dispatch < (time.time() - self.send_interval):
-            self.last_dispatch = time.time()
-            if self.send_data and len(self.kpi_buffer):
-                self.__send_data(self.kpi_buffer)
+        now = time.monotonic()
+        interval_due = now >= self._next_flush
+        if interval_due:
+            self._next_flush = now + self.send_interval
+        if self.send_data:
+            # every full batch goes out right away, otherwise batch-size would also cap throughput
+            while len(self.kpi_buffer) >= self.batch_size:
+                chunk = self._events_buf + self.kpi_buffer[:self.batch_size]
+                del self.kpi_buffer[:self.batch_size]
+                self._events_buf = []
+                self.__submit_data(chunk)
+            if interval_due and (self.kpi_buffer or self._events_buf):
+                self.__submit_data(self._events_buf + self.kpi_buffer)
+                self._events_buf = []
                 self.kpi_buffer = []
 
         return False
 
+    def __submit_data(self, data):
+        """
+        Queues datapoints for sending on the background thread.
+        Drops the oldest queued batch if too many sends are pending.
+        """
+        self._pending = [future for future in self._pending if not future.done()]
+        if len(self._pending) >= self.max_pending:
+            for future in self._pending:
+                if future.cancel():
+                    self._pending.remove(future)
+                    self.log.warning("Too many pending sends to Influx, dropped oldest batch")
+                    break
+        self._pending.append(self._executor.submit(self.__send_data_safe, data))
+
+    def __send_data_safe(self, data):
+        try:
+            self.__send_data(data)
+        except Exception:
+            self.log.warning("Failed to send data to Influx: %s", traceback.format_exc())
+
+    def __wait_pending(self):
+        """
+        Waits for queued sends to finish so no datapoints are lost on exit
+        """
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+        self._pending = []
+
 
     def __send_data(self, data):
         """
-        :type data: list[bzt.modules.aggregator.DataPoint]
+        :type data: list[bytes]
         """
-      
-        serialized_list = self._dpoint_serializer.get_kpi_body(data)
-        self.influx_application
-        requestBody = ""
-        for item in serialized_list: 
-            requestBody = requestBody + self.influx_measurement +  ",application=" + self.influx_application + ","+ str(item) + "\n"
-        self.__send_kpi_data(requestBody)
+        if not data:
+            return
+        # payload buffer is reused between flushes, only one send runs at a time
+        buf = self._payload_buf
+        try:
+            if self.udp_kpi:
+                for line in data:
+                    if buf and len(buf) + len(line) > self.UDP_PAYLOAD_SIZE:
+                        self.__send_udp(buf)
+                        buf.clear()
+                    buf += line
+                self.__send_udp(buf)
+            else:
+                for line in data:
+                    buf += line
+                self.__send_kpi_data(buf)
+        finally:
+            buf.clear()
+
+    def __send_udp(self, data):
+        """
+        Sends line protocol to the Influx UDP listener, delivery is not acknowledged
+
+        :type data: bytes|bytearray
+        """
+        try:
+            self._udp_sock.sendto(data, self._udp_addr)
+        except OSError:
+            self.log.warning("Failed to send data to Influx over UDP, datapoints dropped.")
+            self.log.debug("Error sending UDP data to Influx: %s", traceback.format_exc())
 
     def aggregated_second(self, data):
         """
@@ -126,7 +297,14 @@ class InfluxUploader(Reporter, AggregatorListener, MonitoringListener, Singleton
         """
         self.log.debug("Recieved data: %s", data)
         if self.send_data:
-            self.kpi_buffer.append(data)
+            # serialize right away, buffering the line protocol is much smaller than the DataPoint
+            prefix = self._line_prefix
+            serialized_list = self._dpoint_serializer.get_kpi_body([data])
+            self.kpi_buffer.extend((prefix + item + "\n").encode("utf-8") for item in serialized_list)
+            if len(self.kpi_buffer) > self.max_buffer:
+                dropped = len(self.kpi_buffer) - self.max_buffer
+                del self.kpi_buffer[:dropped]
+                self.log.warning("Influx buffer full, dropped %d oldest rows", dropped)
 
     def monitoring_data(self, data):
         if self.send_monitoring:
@@ -147,27 +325,25 @@ class InfluxUploader(Reporter, AggregatorListener, MonitoringListener, Singleton
         """
         Sends online data to influx
 
-        :type data: str
+        :type data: bytes|bytearray
         """
         url = self.influx_url
         hdr = {"Content-Type": "text/plain"}
+        if self.gzip:
+            # line protocol is very repetitive, level 3 is plenty for it
+            data = gzip.compress(data, compresslevel=3)
+            hdr["Content-Encoding"] = "gzip"
+        elif isinstance(data, bytearray):
+            # requests would treat a bytearray as an iterable stream
+            data = bytes(data)
         try:
-            response = requests.post(url, data, headers=hdr)
+            response = self._session.post(url, data=data, headers=hdr, timeout=(5, 30))
             if response.status_code > 204:
                 self.log.info("Response code from Influx higher than 204. Data possibly not saved.")
                 self.log.debug("Response code from Influx: %s", response)
-        except (ConnectionError):
-            self.log.debug("Error sending data: %s", traceback.format_exc())
-            self.log.warning("Failed to send data to Influx, will retry in %s seconds", str(self.resend_timeout))
-            time.sleep(self.resend_timeout)
-            try:
-                response = requests.post(url, data, headers=hdr)
-                if response.status_code > 204:
-                    self.log.info("Response code from Influx higher than 204. Data possibly not saved.")
-                    self.log.debug("Response code from Influx: %s", response)
-            except (ConnectionError) :
-                self.log.error("Fatal error sending data. Could not connect to Influx server. Datapoints dropped.")
-                self.log.debug("Fatal error sending data to Influx: %s", traceback.format_exc())
+        except self.NETWORK_PROBLEMS:
+            self.log.error("Fatal error sending data. Could not connect to Influx server. Datapoints dropped.")
+            self.log.debug("Fatal error sending data to Influx: %s", traceback.format_exc())
 
 # Borrowed heavily from Blazemeter's DatapointSerializer
 class InfluxDatapointSerializer(object):
@@ -178,6 +354,7 @@ class InfluxDatapointSerializer(object):
         super(InfluxDatapointSerializer, self).__init__()
         self.owner = owner
         self.multi = 1000  # multiplier factor for reporting
+        self.int_suffix = "i"  # line protocol suffix for integer fields, empty to send them untyped
 
     def get_kpi_body(self, data_buffer):
         """
@@ -186,11 +363,22 @@ class InfluxDatapointSerializer(object):
         
         report_items = []
         if data_buffer:
+            # bind lookups once, this loop runs for every label of every buffered second
+            ts_key = DataPoint.TIMESTAMP
+            current_key = DataPoint.CURRENT
+            get_strings = self.__get_transaction_strings
+            extend = report_items.extend
+            ts_multi = self.owner.ts_multi
             for dpoint in data_buffer: #last item is a summary. [:-1]
-                time_stamp = dpoint[DataPoint.TIMESTAMP] * 1000
-                for label, kpi_set in iteritems(dpoint[DataPoint.CURRENT]):
-                    if label:
-                        report_items += (self.__get_transaction_strings(kpi_set, str(time_stamp), label))
+                ts_str = f"{dpoint[ts_key] * ts_multi}"
+                for label, kpi_set in dpoint[current_key].items():
+                    if not label:
+                        continue
+                    try:
+                        extend(get_strings(kpi_set, ts_str, label))
+                    except Exception as exc:
+                        # one bad label must not drop the whole flush
+                        self.owner.log.warning("Serializer skipped label %s: %s", label, exc)
         
         return report_items
 
@@ -198,54 +386,52 @@ class InfluxDatapointSerializer(object):
     def __get_transaction_strings(self, item, time_stamp, label):
         """ 
         Returns the transaction details in a string as per Influx's expected format
+        time_stamp is expected already formatted as a string
         Sample request body for a single transaction    
-        jmeter,application=influx_testing,statut=ok,transaction=TransactionB count=1,avg=502.0,min=502.0,max=502.0,pct95.0=502.0,pct99.0=502.0,pct90.0=502.0 1544587272199000000
+        jmeter,application=influx_testing,statut=ok,transaction=TransactionB count=1i,avg=502i,min=502i,max=502i,pct95.0=502i,pct99.0=502i,pct90.0=502i 1544587272199
         """
 
         txn_status="ok"
         stringList=[]
+        mul = self.multi
+        i = self.int_suffix
 
-        if item[KPISet.FAILURES]>0:
+        pcts = item[KPISet.PERCENTILES]
+        count = item[KPISet.SAMPLE_COUNT] or 0
+        conc = int(item[KPISet.CONCURRENCY])
+        fails = item[KPISet.FAILURES]
+        if fails>0:
             txn_status="ko"
 
-        txnString = "statut=" + txn_status + \
-            ",transaction=" + label + \
-            " count=" + str(item[KPISet.SAMPLE_COUNT]) + \
-            ",avg=" + str(int(self.multi * item[KPISet.AVG_RESP_TIME])) + \
-            ",min=" + str(int(self.multi * item[KPISet.PERCENTILES]["0.0"]) if "0.0" in item[KPISet.PERCENTILES] else "0") + \
-            ",max=" + str(int(self.multi * item[KPISet.PERCENTILES]["100.0"]) if "100.0" in item[KPISet.PERCENTILES] else "0") + \
-            ",pct90.0=" + str(int(item[KPISet.PERCENTILES]["90.0"]) if "90.0" in item[KPISet.PERCENTILES] else "0") + \
-            ",pct95.0=" + str(int(item[KPISet.PERCENTILES]["95.0"]) if "95.0" in item[KPISet.PERCENTILES] else "0") + \
-            ",pct99.0=" + str(int(item[KPISet.PERCENTILES]["99.0"]) if "99.0" in item[KPISet.PERCENTILES] else "0") + \
-            ",maxAT="+ str(item[KPISet.CONCURRENCY]) + \
-            ",countError=" + str(item[KPISet.FAILURES]) + \
-            ",txnsum=" + str(int(self.multi * item[KPISet.AVG_RESP_TIME]) * item[KPISet.SAMPLE_COUNT]) + \
-            ",txnstddev=" + str(int(self.multi * item[KPISet.STDEV_RESP_TIME])) + \
-            ",ltavg=" + str(int(self.multi * item[KPISet.AVG_LATENCY])) + \
-            ",bytessum=" + str(item[KPISet.BYTE_COUNT]) + \
-            ",bytesavg=" + str((item[KPISet.BYTE_COUNT] / float(item[KPISet.SAMPLE_COUNT]))) + \
-            " " + str(time_stamp)
+        bytes_sum = item[KPISet.BYTE_COUNT]
+        bytes_avg = bytes_sum / count if count else 0.0
+        avg_ms = int(mul * item[KPISet.AVG_RESP_TIME])
+        stddev_ms = int(mul * item[KPISet.STDEV_RESP_TIME])
+        lat_ms = int(mul * item[KPISet.AVG_LATENCY])
+        mn = int(mul * pcts["0.0"]) if "0.0" in pcts else 0
+        mx = int(mul * pcts["100.0"]) if "100.0" in pcts else 0
+        p90 = int(pcts["90.0"]) if "90.0" in pcts else 0
+        p95 = int(pcts["95.0"]) if "95.0" in pcts else 0
+        p99 = int(pcts["99.0"]) if "99.0" in pcts else 0
+
+        label_prefix = f"transaction={_tag_value(label)}"
+        txnString = f"statut={txn_status},{label_prefix}" \
+            f" count={count}{i},avg={avg_ms}{i},min={mn}{i},max={mx}{i}" \
+            f",pct90.0={p90}{i},pct95.0={p95}{i},pct99.0={p99}{i}" \
+            f",maxAT={conc}{i},countError={fails}{i},txnsum={avg_ms * count}{i}" \
+            f",txnstddev={stddev_ms}{i},ltavg={lat_ms}{i}" \
+            f",bytessum={bytes_sum}{i},bytesavg={bytes_avg!r}" \
+            f" {time_stamp}"
         stringList.append(txnString)
 
         #volume details for reporting of max threads.  JMeter logs this on each transaction, however Influx expects it as a seperate row of data.
-        internalString = "transaction=internal" + \
-            " minAT="+ str(item[KPISet.CONCURRENCY]) + \
-            ",maxAT="+ str(item[KPISet.CONCURRENCY]) + \
-            ",meanAT="+ str(item[KPISet.CONCURRENCY]) + \
-            ",startedT="+ str(item[KPISet.CONCURRENCY]) + \
-            ",endedT=0" + \
-            " " + str(time_stamp)
+        internalString = f"transaction=internal minAT={conc}{i},maxAT={conc}{i},meanAT={conc}{i},startedT={conc}{i},endedT=0{i} {time_stamp}"
         stringList.append(internalString)
 
         #error details are reported as seperate rows in influx.
-        errors = item[KPISet.ERRORS]
-        errorString = ""
-        for error in errors:
-            errorString= "transaction=" + label + \
-                ",responseMessage=" + str(error['msg']) + \
-                ",responseCode=" + str(error['rc']) + \
-                " count=" + str(error['cnt']) + \
-                " " + str(time_stamp)
-            stringList.append(errorString)
-        
+        stringList.extend(
+            f"{label_prefix},responseMessage={_tag_value(error['msg'])}"
+            f",responseCode={_tag_value(error['rc'])} count={error['cnt']}{i} {time_stamp}"
+            for error in item[KPISet.ERRORS])
+
         return stringList
\ No newline at end of file